@@ -2,13 +2,20 @@
 """Exports Dyson Pure Hot+Cool (DysonLink) statistics as Prometheus metrics."""
 
 import argparse
+import concurrent.futures
+import configparser
 import functools
+import heapq
+import itertools
 import logging
+import math
+import random
+import signal
 import sys
 import time
 import threading
 
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import prometheus_client
 import libdyson
@@ -18,23 +25,177 @@ import libdyson.exceptions
 import config
 import metrics
 
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """A callback waiting in the RefreshScheduler heap."""
+
+    def __init__(self, callback: Callable, args=(), interval: Optional[float] = None):
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Prevents the callback from running (again)."""
+        self.cancelled = True
+
+
+class RefreshScheduler(threading.Thread):
+    """Runs periodic device refreshes (and one-off callbacks) on one thread.
+
+    Entries are kept in a heap ordered by due time. Periodic entries are due
+    on a grid of multiples of their interval (counted from when the scheduler
+    was created), regardless of when they were armed; so N devices sharing an
+    interval fall due together and cost one wakeup per interval rather than N. Periodic refreshes run on the scheduler thread
+    itself and should be quick; one-off callbacks (e.g; connect retries, which
+    can block for tens of seconds) run on a small executor so they can't hold
+    up everyone else's refreshes.
+
+    Args:
+      max_workers: maximum number of one-off callbacks to run concurrently.
+      clock: returns the current time in seconds; for tests.
+    """
+
+    def __init__(self, max_workers: int = 4, clock: Callable[[], float] = time.monotonic):
+        super().__init__(name='refresh-scheduler', daemon=True)
+        self._clock = clock
+        self._epoch = clock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='refresh-scheduler-worker')
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, _Entry]] = []
+        self._seq = itertools.count()
+        self._armed: Dict['DeviceWrapper', _Entry] = {}
+        self._stopped = False
+
+    def arm(self, device: 'DeviceWrapper', interval: float) -> None:
+        """Calls device._timer_callback() every interval seconds until disarm().
+
+        The first call happens at the next tick of the interval's grid, so it
+        may come sooner than interval seconds from now.
+        """
+        with self._cond:
+            self.disarm(device)
+            entry = _Entry(device._timer_callback, interval=interval)
+            self._armed[device] = entry
+            self._push(self._next_tick(self._clock(), interval), entry)
+
+    def disarm(self, device: 'DeviceWrapper') -> None:
+        """Stops periodic refreshes for device; a no-op if it isn't armed."""
+        with self._cond:
+            entry = self._armed.pop(device, None)
+            if entry:
+                entry.cancel()
+
+    def call_later(self, delay: float, callback: Callable, *args) -> _Entry:
+        """Schedules callback(*args) to be run once (on the executor), after delay seconds.
+
+        Returns:
+          The scheduled entry; call cancel() on it to prevent it running.
+        """
+        entry = _Entry(callback, args)
+        with self._cond:
+            self._push(self._clock() + delay, entry)
+        return entry
+
+    def stop(self) -> None:
+        """Stops the scheduler; nothing further is dispatched.
+
+        One-off callbacks that haven't started yet are dropped. Any already
+        running (e.g; a connect retry) can't be interrupted and will still be
+        waited on at interpreter exit, bounded by libdyson's connect timeout
+        (~20 seconds).
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _next_tick(self, now: float, interval: float) -> float:
+        """Returns the first multiple of interval (since _epoch) after now."""
+        return self._epoch + (math.floor((now - self._epoch) / interval) + 1) * interval
+
+    def _push(self, due: float, entry: _Entry) -> None:
+        heapq.heappush(self._heap, (due, next(self._seq), entry))
+        self._cond.notify()
+
+    def run(self) -> None:
+        while True:
+            self._run_pending()
+            with self._cond:
+                if self._stopped:
+                    return
+                # Recomputed under the lock, so we can't miss a _push().
+                timeout = self._heap[0][0] - self._clock() if self._heap else None
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+
+    def _run_pending(self) -> None:
+        """Dispatches every entry that is due now."""
+        with self._cond:
+            if self._stopped:
+                return
+            now = self._clock()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                _, _, entry = heapq.heappop(self._heap)
+                if entry.cancelled:
+                    continue
+                due.append(entry)
+                if entry.interval is not None:
+                    self._push(self._next_tick(now, entry.interval), entry)
+
+        # Dispatch outside the lock, so callbacks can (re)schedule.
+        for entry in due:
+            if entry.interval is None:
+                try:
+                    self._executor.submit(self._dispatch, entry)
+                except RuntimeError:
+                    # stop() shut the executor down under us.
+                    return
+            else:
+                self._dispatch(entry)
+
+    @classmethod
+    def _dispatch(cls, entry: _Entry) -> None:
+        if entry.cancelled:
+            return
+        try:
+            entry.callback(*entry.args)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Scheduled callback %s failed', entry.callback)
+
 
 class DeviceWrapper:
     """Wrapper for a config.Device.
 
     This class has two main purposes:
       1) To associate a device name & libdyson.DysonFanDevice together
-      2) To start background thread that asks the DysonFanDevice for updated
-         environmental data on a periodic basis.
+      2) To periodically ask the DysonFanDevice for updated environmental
+         data, using the shared RefreshScheduler.
 
     Args:
       device: a config.Device to wrap
+      scheduler: a RefreshScheduler to run periodic refreshes (and retries) on
       environment_refresh_secs: how frequently to refresh environmental data
     """
 
-    def __init__(self, device: config.Device, environment_refresh_secs=30):
+    def __init__(self, device: config.Device, scheduler: RefreshScheduler, environment_refresh_secs=30):
         self._config_device = device
+        self._scheduler = scheduler
         self._environment_refresh_secs = environment_refresh_secs
+        # Serialises connect(); it can be called concurrently from discovery,
+        # scheduled retries and re-adds, and libdyson's connect() isn't safe
+        # to run twice at once on the same device.
+        self._connect_lock = threading.Lock()
+        self._retry: Optional[_Entry] = None
+        self._retry_attempt = 0
+        self._discovered_address: Optional[str] = None
+        self._serial_upper = device.serial.upper()
+        # Bound once, so re-adds register the same callable every time.
+        self.discovery_callback = self.on_discovered
         self.libdyson = self._create_libdyson_device()
 
     @property
@@ -47,53 +208,109 @@ class DeviceWrapper:
         """Returns device serial number, e.g; AB1-XX-1234ABCD."""
         return self._config_device.serial
 
+    @property
+    def serial_upper(self) -> str:
+        """Returns the upper-cased device serial number, for hosts lookups."""
+        return self._serial_upper
+
+    @property
+    def discovered_address(self) -> Optional[str]:
+        """Returns the address this device was last discovered on, if any."""
+        return self._discovered_address
+
     @property
     def is_connected(self) -> bool:
         """True if we're connected to the Dyson device."""
         return self.libdyson.is_connected
 
-    def connect(self, host: str, retry_on_timeout_secs: int = 30):
+    def connect(self, host: str, retry_on_timeout_secs: int = 30, max_retry_secs: int = 600):
         """Connect to the device and start the environmental monitoring timer.
 
+        Connection timeouts are retried with exponential backoff (plus jitter,
+        so multiple devices don't retry in lockstep).
+
         Args:
           host: ip or hostname of Dyson device
-          retry_on_timeout_secs: number of seconds to wait in between retries. this will block the running thread.
+          retry_on_timeout_secs: number of seconds to wait before the first retry.
+          max_retry_secs: upper bound on the (pre-jitter) wait between retries.
         """
-        if self.is_connected:
-            logging.info(
-                'Already connected to %s (%s); no need to reconnect.', host, self.serial)
-        else:
+        with self._connect_lock:
+            if self.is_connected:
+                logging.info(
+                    'Already connected to %s (%s); no need to reconnect.', host, self.serial)
+                self._cancel_retry()
+                return
+
             try:
                 self.libdyson.connect(host)
-                self._refresh_timer()
+                self._cancel_retry()
+                self._retry_attempt = 0
+                self._start_refresh()
             except libdyson.exceptions.DysonConnectTimeout:
+                delay = min(retry_on_timeout_secs * 2 ** self._retry_attempt, max_retry_secs)
+                # Stop growing the exponent once we've hit the cap.
+                if delay < max_retry_secs:
+                    self._retry_attempt += 1
+                delay *= random.uniform(0.5, 1.5)
                 logging.error(
-                    'Timeout connecting to %s (%s); will retry', host, self.serial)
-                threading.Timer(retry_on_timeout_secs,
-                                self.connect, args=[host]).start()
+                    'Timeout connecting to %s (%s); will retry in %.0f seconds',
+                    host, self.serial, delay)
+                # Only ever keep one pending retry, for the most recent host.
+                self._cancel_retry()
+                self._retry = self._scheduler.call_later(
+                    delay, self.connect, host, retry_on_timeout_secs, max_retry_secs)
 
     def disconnect(self):
         """Disconnect from the Dyson device."""
+        self._stop_refresh()
+        self._cancel_retry()
         self.libdyson.disconnect()
 
-    def _refresh_timer(self):
-        timer = threading.Timer(self._environment_refresh_secs,
-                                self._timer_callback)
-        timer.start()
+    def on_discovered(self, address: str):
+        """Callback for DysonDiscovery; connects to the discovered address."""
+        # A note on concurrency: used with DysonDiscovery, this will be called
+        # back in a separate thread created by the underlying zeroconf library.
+        # libdyson's connect() spawns a new thread for MQTT, but then waits
+        # for it to connect, and connect() here is serialised per device; so
+        # this can block the zeroconf thread until an in-flight connect ends.
+        logging.info('Discovered %s on %s', self.serial, address)
+        self._discovered_address = address
+        with self._connect_lock:
+            # Any pending retry is for an older address; this one is fresher,
+            # so it deserves a fresh backoff too.
+            self._cancel_retry()
+            self._retry_attempt = 0
+        self.connect(address)
+
+    def _cancel_retry(self):
+        retry, self._retry = self._retry, None
+        if retry:
+            retry.cancel()
+
+    def _start_refresh(self):
+        # The refresh runs for the lifetime of the connection; it's only
+        # (re)started once connect() succeeds and is stopped in disconnect().
+        self._scheduler.arm(self, self._environment_refresh_secs)
+
+    def _stop_refresh(self):
+        self._scheduler.disarm(self)
 
     def _timer_callback(self):
         if self.is_connected:
-            logging.debug(
-                'Requesting updated environmental data from %s', self.serial)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    'Requesting updated environmental data from %s', self.serial)
             try:
                 self.libdyson.request_environmental_data()
             except AttributeError:
                 logging.error('Race with a disconnect? Skipping an iteration.')
-            self._refresh_timer()
-        else:
-            logging.debug('Device %s is disconnected.', self.serial)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Device %s is disconnected.', self.serial)
 
     def _create_libdyson_device(self):
+        # Each device gets its own MQTT client: the broker runs on the device
+        # itself and authenticates with that device's serial & credentials,
+        # so there's no connection to share between devices.
         return libdyson.get_device(self.serial, self._config_device.credentials,
                                    self._config_device.product_type)
 
@@ -102,7 +319,8 @@ class ConnectionManager:
     """Manages connections via manual IP or via libdyson Discovery.
 
     Args:
-      update_fn: A callable taking a name, serial,
+      update_fn: A callable taking a name, libdyson device, is_state and
+                 is_environmental; called on every message (e.g; Metrics.store).
       devices: a list of config.Device entities
       hosts: a dict of serial -> IP address, for direct (non-zeroconf) connections.
     """
@@ -110,14 +328,23 @@ class ConnectionManager:
     def __init__(self, update_fn: Callable[[str, str, bool, bool], None],
                  devices: List[config.Device], hosts: Dict[str, str]):
         self._update_fn = update_fn
-        self._hosts = hosts
-
-        logging.info('Starting discovery...')
-        self._discovery = libdyson.discovery.DysonDiscovery()
-        self._discovery.start_discovery()
-
-        for device in devices:
-            self._add_device(DeviceWrapper(device))
+        # Config.hosts already upper-cases its keys, but don't rely on callers.
+        self._hosts = {k.upper(): v for k, v in hosts.items()}
+        self._scheduler = RefreshScheduler()
+        self._scheduler.start()
+
+        # Discovery is only started once a device without a configured IP
+        # needs it; see _get_discovery().
+        self._discovery: Optional[libdyson.discovery.DysonDiscovery] = None
+        self._discovery_lock = threading.Lock()
+
+        # Connecting to a device with a configured IP blocks for the MQTT
+        # handshake, so do the initial connects concurrently. DysonDiscovery
+        # has its own lock, and _get_discovery() guards starting it.
+        if devices:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(devices))) as ex:
+                list(ex.map(lambda d: self._add_device(DeviceWrapper(d, self._scheduler)),
+                            devices))
 
     def _add_device(self, device: DeviceWrapper, add_listener=True):
         """Adds and connects to a device.
@@ -131,10 +358,12 @@ class ConnectionManager:
                         add_device() has been called on this device already.
         """
         if add_listener:
+            # Only done once per device, so this partial lives as long as the
+            # device does; re-adds after a disconnect reuse it.
             callback_fn = functools.partial(self._device_callback, device)
             device.libdyson.add_message_listener(callback_fn)
 
-        manual_ip = self._hosts.get(device.serial.upper())
+        manual_ip = self._hosts.get(device.serial_upper)
         if manual_ip:
             logging.info('Attempting connection to device "%s" (serial=%s) via configured IP %s',
                          device.name, device.serial, manual_ip)
@@ -142,27 +371,38 @@ class ConnectionManager:
         else:
             logging.info('Attempting to discover device "%s" (serial=%s) via zeroconf',
                          device.name, device.serial)
-            callback_fn = functools.partial(self._discovery_callback, device)
-            self._discovery.register_device(device.libdyson, callback_fn)
-
-    @classmethod
-    def _discovery_callback(cls, device: DeviceWrapper, address: str):
-        # A note on concurrency: used with DysonDiscovery, this will be called
-        # back in a separate thread created by the underlying zeroconf library.
-        # When we call connect() on libpurecool or libdyson, that code spawns
-        # a new thread for MQTT and returns. In other words: we don't need to
-        # worry about connect() blocking zeroconf here.
-        logging.info('Discovered %s on %s', device.serial, address)
-        device.connect(address)
+            self._get_discovery().register_device(device.libdyson, device.discovery_callback)
+
+            # Discovery keeps running across disconnects, and zeroconf won't
+            # tell us about a device it has already seen unless the device
+            # re-announces itself. So if we've found it before, try there
+            # too. connect() is serialised per device, so this can't race
+            # with on_discovered(); a fresh discovery cancels retries here.
+            if device.discovered_address:
+                logging.info('Reconnecting to device "%s" (serial=%s) at last discovered IP %s',
+                             device.name, device.serial, device.discovered_address)
+                device.connect(device.discovered_address)
+
+    def stop(self):
+        """Stops periodic refreshes and pending connect retries."""
+        self._scheduler.stop()
+
+    def _get_discovery(self) -> libdyson.discovery.DysonDiscovery:
+        """Returns the DysonDiscovery instance, starting it on first use."""
+        with self._discovery_lock:
+            if not self._discovery:
+                logging.info('Starting discovery...')
+                self._discovery = libdyson.discovery.DysonDiscovery()
+                self._discovery.start_discovery()
+            return self._discovery
 
     def _device_callback(self, device, message):
-        logging.debug('Received update from %s: %s', device.serial, message)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Received update from %s: %s', device.serial, message)
         if not device.is_connected:
             logging.info(
                 'Device %s is now disconnected, clearing it and re-adding', device.serial)
             device.disconnect()
-            self._discovery.stop_discovery()
-            self._discovery.start_discovery()
             self._add_device(device, add_listener=False)
             return
 
@@ -173,12 +413,21 @@ class ConnectionManager:
 
 
 def _sleep_forever() -> None:
-    """Sleeps the calling thread until a keyboard interrupt occurs."""
-    while True:
+    """Sleeps the calling thread until SIGINT or SIGTERM is received."""
+    stop = threading.Event()
+    if sys.platform == 'win32':
+        # Event.wait() can't be interrupted to run signal handlers on Windows,
+        # so poll (with the default SIGINT handler) for the KeyboardInterrupt.
         try:
-            time.sleep(1)
+            while not stop.wait(timeout=1):
+                pass
         except KeyboardInterrupt:
-            break
+            pass
+        return
+
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    stop.wait()
 
 
 def main(argv):
@@ -189,19 +438,15 @@ def main(argv):
     parser.add_argument(
         '--config', help='Configuration file (INI file)', default='config.ini')
     parser.add_argument(
-        '--log_level', help='Logging level (DEBUG, INFO, WARNING, ERROR)', type=str, default='INFO')
+        '--log_level', help='Logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        default='INFO')
     parser.add_argument(
         '--include_inactive_devices',
         help='Do not use; this flag has no effect and remains for compatibility only',
         action='store_true')
     args = parser.parse_args()
 
-    try:
-        level = getattr(logging, args.log_level)
-    except AttributeError:
-        print(f'Invalid --log_level: {args.log_level}')
-        sys.exit(-1)
-    args = parser.parse_args()
+    level = getattr(logging, args.log_level)
 
     logging.basicConfig(
         format='%(asctime)s [%(thread)d] %(levelname)10s %(message)s',
@@ -216,7 +461,7 @@ def main(argv):
 
     try:
         cfg = config.Config(args.config)
-    except:
+    except (configparser.Error, OSError, ValueError):
         logging.exception('Could not load configuration: %s', args.config)
         sys.exit(-1)
 
@@ -228,10 +473,13 @@ def main(argv):
 
     prometheus_client.start_http_server(args.port)
 
-    ConnectionManager(metrics.Metrics().update, devices, cfg.hosts)
+    manager = ConnectionManager(metrics.Metrics().store, devices, cfg.hosts)
 
     _sleep_forever()
 
+    logging.info('Shutting down')
+    manager.stop()
+
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,339 @@
+"""Unit test for the RefreshScheduler and DeviceWrapper in main.
+
+Most of these tests don't start the scheduler thread; instead they drive it
+with a fake clock and call _run_pending() directly, so periodic entries are
+dispatched deterministically. One-off callbacks still run on the executor,
+so those tests wait on an Event.
+"""
+
+import threading
+import time
+import unittest
+import unittest.mock
+
+import libdyson.exceptions
+
+import config
+import main
+
+INTERVAL = 10
+TIMEOUT = 5
+DEVICE = config.Device('test device', 'XX1-ZZ-1234ABCD', 'credz', '455')
+
+
+class FakeClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, secs):
+        self.now += secs
+
+
+class FakeDevice:
+    """Stands in for a DeviceWrapper; records _timer_callback() calls."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.ticks = []
+
+    def _timer_callback(self):
+        self.ticks.append(self._clock())
+
+
+class TestRefreshScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = main.RefreshScheduler(clock=self.clock)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def advance(self, secs):
+        self.clock.advance(secs)
+        self.scheduler._run_pending()
+
+    def test_arm_disarm(self):
+        device = FakeDevice(self.clock)
+        self.scheduler.arm(device, INTERVAL)
+        self.advance(INTERVAL / 2)
+        self.assertEqual(len(device.ticks), 0)
+
+        for _ in range(3):
+            self.advance(INTERVAL)
+        self.assertEqual(len(device.ticks), 3)
+
+        self.scheduler.disarm(device)
+        self.advance(INTERVAL * 3)
+        self.assertEqual(len(device.ticks), 3)
+
+    def test_devices_armed_apart_fire_together(self):
+        first, second = FakeDevice(self.clock), FakeDevice(self.clock)
+        self.scheduler.arm(first, INTERVAL)
+        self.advance(INTERVAL * 0.3)
+        self.scheduler.arm(second, INTERVAL)
+
+        # Step finely, so devices on different phases would tick at different times.
+        for _ in range(INTERVAL * 3):
+            self.advance(1)
+
+        self.assertEqual(len(first.ticks), 3)
+        self.assertEqual(first.ticks, second.ticks)
+
+    def test_rearm_replaces_entry(self):
+        device = FakeDevice(self.clock)
+        self.scheduler.arm(device, INTERVAL)
+        self.scheduler.arm(device, INTERVAL)
+        for _ in range(4):
+            self.advance(INTERVAL)
+
+        self.assertEqual(len(device.ticks), 4)
+
+    def test_call_later(self):
+        ran = threading.Event()
+        self.scheduler.call_later(INTERVAL, ran.set)
+        self.advance(INTERVAL / 2)
+        self.assertFalse(ran.is_set())
+
+        self.advance(INTERVAL)
+        self.assertTrue(ran.wait(timeout=TIMEOUT))
+
+    def test_call_later_cancel(self):
+        got = []
+        kept = threading.Event()
+        entry = self.scheduler.call_later(INTERVAL, got.append, 'cancelled')
+        self.scheduler.call_later(INTERVAL, lambda: (got.append('kept'), kept.set()))
+        entry.cancel()
+        self.advance(INTERVAL)
+
+        self.assertTrue(kept.wait(timeout=TIMEOUT))
+        self.assertEqual(got, ['kept'])
+
+    def test_slow_callback_does_not_delay_refresh(self):
+        device = FakeDevice(self.clock)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(timeout=TIMEOUT)
+
+        self.scheduler.arm(device, INTERVAL)
+        self.scheduler.call_later(0, slow)
+        self.scheduler._run_pending()
+        self.assertTrue(started.wait(timeout=TIMEOUT))
+
+        # slow() is still blocked, but refreshes keep being dispatched.
+        for _ in range(3):
+            self.advance(INTERVAL)
+        self.assertEqual(len(device.ticks), 3)
+        release.set()
+
+    def test_callback_exception_is_logged(self):
+        def boom():
+            raise RuntimeError('boom')
+
+        ran = threading.Event()
+        with self.assertLogs(level='ERROR'):
+            self.scheduler.call_later(0, boom)
+            self.scheduler.call_later(0, ran.set)
+            self.scheduler._run_pending()
+            self.assertTrue(ran.wait(timeout=TIMEOUT))
+
+    def test_stop(self):
+        got = []
+        self.scheduler.call_later(0, got.append, 'late')
+        self.scheduler.stop()
+        self.scheduler._run_pending()
+        self.assertEqual(got, [])
+
+    def test_run_thread(self):
+        scheduler = main.RefreshScheduler()
+        scheduler.start()
+
+        ran = threading.Event()
+        scheduler.call_later(0, ran.set)
+        self.assertTrue(ran.wait(timeout=TIMEOUT))
+
+        scheduler.stop()
+        scheduler.join(timeout=TIMEOUT)
+        self.assertFalse(scheduler.is_alive())
+
+
+class FakeLibDyson:
+    """Stands in for a libdyson device; connect() blocks, then succeeds or times out."""
+
+    def __init__(self, fail_hosts=()):
+        self.is_connected = False
+        self.fail_hosts = fail_hosts
+        self.connects = []
+        self.listeners = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def connect(self, host):
+        with self._lock:
+            self.connects.append(host)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        # Give a concurrent connect() the chance to overlap, were it allowed to.
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        if host in self.fail_hosts:
+            raise libdyson.exceptions.DysonConnectTimeout
+        self.is_connected = True
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def add_message_listener(self, callback):
+        self.listeners.append(callback)
+
+
+class FakeDiscovery:
+    """Stands in for libdyson's DysonDiscovery; records calls."""
+
+    def __init__(self):
+        self.starts = 0
+        self.stops = 0
+        self.registered = []
+
+    def start_discovery(self):
+        self.starts += 1
+
+    def stop_discovery(self):
+        self.stops += 1
+
+    def register_device(self, device, callback):
+        self.registered.append((device, callback))
+
+
+class TestDeviceWrapper(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = main.RefreshScheduler(clock=self.clock)
+        self.device = main.DeviceWrapper(DEVICE, self.scheduler)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_concurrent_connects_are_serialised(self):
+        self.device.libdyson = FakeLibDyson()
+        threads = [threading.Thread(target=self.device.connect, args=(host,))
+                   for host in ('1.2.3.4', '5.6.7.8')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.device.libdyson.max_active, 1)
+        # The second connect() sees the first one's connection and backs off.
+        self.assertEqual(len(self.device.libdyson.connects), 1)
+
+    def test_discovery_cancels_pending_retry(self):
+        self.device.libdyson = FakeLibDyson(fail_hosts=('1.2.3.4',))
+        with self.assertLogs(level='ERROR'):
+            self.device.connect('1.2.3.4')
+        retry = self.device._retry
+        self.assertIsNotNone(retry)
+
+        self.device.on_discovered('5.6.7.8')
+
+        self.assertTrue(retry.cancelled)
+        self.assertIsNone(self.device._retry)
+        self.assertTrue(self.device.is_connected)
+        self.assertEqual(self.device.libdyson.connects, ['1.2.3.4', '5.6.7.8'])
+
+
+class TestDeviceWrapperBackoff(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = main.RefreshScheduler(clock=self.clock)
+        self.device = main.DeviceWrapper(DEVICE, self.scheduler)
+        self.device.libdyson = FakeLibDyson(fail_hosts={'1.2.3.4', '5.6.7.8'})
+
+        # No jitter, so the delays are predictable.
+        patcher = unittest.mock.patch('random.uniform', return_value=1.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def connect(self, host, times=1):
+        """Connects times times, returning the retry delays scheduled."""
+        with unittest.mock.patch.object(
+                self.scheduler, 'call_later', wraps=self.scheduler.call_later) as call_later:
+            with self.assertLogs(level='ERROR'):
+                for _ in range(times):
+                    self.device.connect(host, retry_on_timeout_secs=30, max_retry_secs=600)
+        return [c.args[0] for c in call_later.call_args_list]
+
+    def test_backoff_grows_to_cap(self):
+        self.assertEqual(self.connect('1.2.3.4', times=7),
+                         [30, 60, 120, 240, 480, 600, 600])
+        self.assertLessEqual(self.device._retry_attempt, 5)
+
+    def test_backoff_resets_after_success(self):
+        self.assertEqual(self.connect('1.2.3.4', times=3), [30, 60, 120])
+
+        self.device.libdyson.fail_hosts = set()
+        self.device.connect('1.2.3.4')
+        self.device.disconnect()
+
+        self.device.libdyson.fail_hosts = {'1.2.3.4'}
+        self.assertEqual(self.connect('1.2.3.4', times=2), [30, 60])
+
+    def test_backoff_resets_on_discovery(self):
+        self.assertEqual(self.connect('1.2.3.4', times=3), [30, 60, 120])
+
+        with unittest.mock.patch.object(
+                self.scheduler, 'call_later', wraps=self.scheduler.call_later) as call_later:
+            with self.assertLogs(level='ERROR'):
+                self.device.on_discovered('5.6.7.8')
+        self.assertEqual(call_later.call_args.args[0], 30)
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch('libdyson.discovery.DysonDiscovery', FakeDiscovery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.manager = main.ConnectionManager(lambda *_, **__: None, [], {})
+        self.device = main.DeviceWrapper(DEVICE, self.manager._scheduler)
+        self.device.libdyson = FakeLibDyson()
+
+    def tearDown(self):
+        self.manager.stop()
+
+    def test_readd_after_disconnect_keeps_discovery_running(self):
+        self.manager._add_device(self.device)
+        discovery = self.manager._discovery
+        self.assertEqual(len(discovery.registered), 1)
+
+        # Zeroconf finds the device.
+        _, callback = discovery.registered[0]
+        callback('5.6.7.8')
+        self.assertTrue(self.device.is_connected)
+
+        # The MQTT link drops; the next message notices and re-adds the device.
+        self.device.libdyson.is_connected = False
+        for listener in self.device.libdyson.listeners:
+            listener(libdyson.MessageType.STATE)
+
+        self.assertEqual(discovery.starts, 1)
+        self.assertEqual(discovery.stops, 0)
+        self.assertEqual(len(discovery.registered), 2)
+        self.assertEqual(self.device.libdyson.connects, ['5.6.7.8', '5.6.7.8'])
+        self.assertTrue(self.device.is_connected)
+
+
+if __name__ == '__main__':
+    unittest.main()
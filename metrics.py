@@ -3,6 +3,8 @@
 import datetime
 import enum
 import logging
+import threading
+from typing import Dict, Optional, Tuple
 
 import libdyson
 import libdyson.const
@@ -80,18 +82,48 @@ class OffHeat(enum.Enum):
         return OffHeat.HEAT.value if value else OffHeat.OFF.value
 
 
+class Snapshot:
+    """The most recent update received from a device, pending the next scrape.
+
+    libdyson devices hold their own (live) state, so we just remember which
+    device it was and when we last heard about its state & environment.
+    """
+
+    def __init__(self, device: libdyson.dyson_device.DysonFanDevice):
+        self.device = device
+        self.state_timestamp: Optional[str] = None
+        self.environmental_timestamp: Optional[str] = None
+
+
 class Metrics:
-    """Registers/exports and updates Prometheus metrics for DysonLink fans."""
+    """Registers/exports and updates Prometheus metrics for DysonLink fans.
+
+    Updates can be applied immediately with update(), or recorded with
+    store() and applied when Prometheus next scrapes us. The latter keeps
+    the per-message cost in the MQTT callback to a dict write.
+    """
 
     def __init__(self, registry=REGISTRY):
         labels = ['name', 'serial']
 
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        # Keyed by (name, serial), like the metrics' labels; names needn't be unique.
+        self._latest: Dict[Tuple[str, str], Snapshot] = {}
+        self._metrics = []
+
+        # Metrics aren't registered individually; this class is registered
+        # as the collector for all of them (see collect()).
         def make_gauge(name, documentation):
-            return Gauge(name, documentation, labels, registry=registry)
+            metric = Gauge(name, documentation, labels, registry=None)
+            self._metrics.append(metric)
+            return metric
 
         def make_enum(name, documentation, state_cls):
-            return Enum(name, documentation, labels, states=enum_values(state_cls),
-                        registry=registry)
+            metric = Enum(name, documentation, labels, states=enum_values(state_cls),
+                          registry=None)
+            self._metrics.append(metric)
+            return metric
 
         # Last update timestamps. Use Gauge here as we can set arbitrary
         # values; Counter requires inc().
@@ -179,8 +211,56 @@ class Metrics:
         self.dyson_front_direction_mode = make_enum(
             'dyson_front_direction_mode', 'Airflow direction from front (V2 units only)', OffOn)
 
+        if registry:
+            registry.register(self)
+
+    def describe(self):
+        """Describes our metrics to the registry, without rendering updates."""
+        return [f for m in self._metrics for f in m.describe()]
+
+    def collect(self):
+        """Applies updates recorded by store(), then returns all metrics.
+
+        This is called by the Prometheus client on every scrape.
+        """
+        with self._lock:
+            latest, self._latest = self._latest, {}
+
+        with self._render_lock:
+            for (name, _), snapshot in latest.items():
+                # One misbehaving device shouldn't fail the whole scrape.
+                try:
+                    if snapshot.state_timestamp:
+                        self.update(name, snapshot.device, is_state=True,
+                                    updated_at=snapshot.state_timestamp)
+                    if snapshot.environmental_timestamp:
+                        self.update(name, snapshot.device, is_environmental=True,
+                                    updated_at=snapshot.environmental_timestamp)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('Could not update metrics for "%s" (serial=%s)',
+                                      name, snapshot.device.serial)
+            return [f for m in self._metrics for f in m.collect()]
+
+    def store(self, name: str, device: libdyson.dyson_device.DysonFanDevice, is_state=False,
+              is_environmental=False) -> None:
+        """Records an update, to be applied to Prometheus metrics on the next scrape.
+
+        Takes the same arguments as update().
+        """
+        now = timestamp()
+        key = (name, device.serial)
+        with self._lock:
+            snapshot = self._latest.get(key)
+            if not snapshot:
+                snapshot = self._latest[key] = Snapshot(device)
+            snapshot.device = device
+            if is_state:
+                snapshot.state_timestamp = now
+            if is_environmental:
+                snapshot.environmental_timestamp = now
+
     def update(self, name: str, device: libdyson.dyson_device.DysonFanDevice, is_state=False,
-               is_environmental=False) -> None:
+               is_environmental=False, updated_at: Optional[str] = None) -> None:
         """Receives device/environment state and updates Prometheus metrics.
 
         Args:
@@ -188,6 +268,7 @@ class Metrics:
           device: a libdyson.Device instance.
           is_state: is a device state (power, fan mode, etc) update.
           is_enviromental: is an environmental (temperature, humidity, etc) update.
+          updated_at: Unix timestamp the update was received at; defaults to now.
         """
         if not device:
             logging.error('Ignoring update, device is None')
@@ -209,6 +290,13 @@ class Metrics:
         else:
             logging.warning('Received unknown update from "%s" (serial=%s): %s; ignoring',
                             name, serial, type(device))
+            return
+
+        updated_at = updated_at or timestamp()
+        if is_state:
+            update_gauge(self.last_update_state, name, serial, updated_at)
+        if is_environmental:
+            update_gauge(self.last_update_environmental, name, serial, updated_at)
 
     def update_v1_environmental(self, name: str, device) -> None:
         self.update_common_environmental(name, device)
@@ -241,9 +329,6 @@ class Metrics:
           update_env_gauge(self.formaldehyde, name, device.serial, device.formaldehyde)
 
     def update_common_environmental(self, name: str, device) -> None:
-        update_gauge(self.last_update_environmental,
-                     name, device.serial, timestamp())
-
         temp = round(device.temperature + KELVIN_TO_CELSIUS, 1)
         update_env_gauge(self.humidity, name, device.serial, device.humidity)
         update_env_gauge(self.temperature, name, device.serial, temp)
@@ -318,8 +403,6 @@ class Metrics:
             self.update_common_heating(name, device)
 
     def update_common_state(self, name: str, device) -> None:
-        update_gauge(self.last_update_state, name, device.serial, timestamp())
-
         update_enum(self.fan_state, name, device.serial,
                     OffFan.translate_bool(device.fan_state))
         update_enum(self.night_mode, name, device.serial,
@@ -58,6 +58,68 @@ class TestMetrics(unittest.TestCase):
             got = self.registry.get_sample_value(metric, labels)
             self.assertEqual(got, want, f'metric {metric}')
 
+    def test_store_applied_on_collect(self):
+        device = libdyson.DysonPureCoolLink(
+            SERIAL, CREDENTIALS, libdyson.DEVICE_TYPE_PURE_COOL_LINK)
+        payload = {
+            'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA',
+            'time': '2021-03-17T15:09:23.000Z',
+            'data': {'tact': '2956', 'hact': '0047', 'pact': '0005', 'vact': 'INIT', 'sltm': 'OFF'}
+        }
+        device._handle_message(payload)
+
+        labels = {'name': NAME, 'serial': SERIAL}
+        self.metrics.store(NAME, device, is_state=False,
+                           is_environmental=True)
+
+        # get_sample_value() collects, i.e; simulates a scrape.
+        self.assertEqual(self.registry.get_sample_value(
+            'dyson_temperature_celsius', labels), 22.6)
+        self.assertIsNotNone(self.registry.get_sample_value(
+            'dyson_last_environmental_timestamp_seconds', labels))
+        self.assertIsNone(self.registry.get_sample_value(
+            'dyson_last_state_timestamp_seconds', labels))
+
+    def test_store_bad_device_does_not_fail_scrape(self):
+        good = libdyson.DysonPureCoolLink(
+            SERIAL, CREDENTIALS, libdyson.DEVICE_TYPE_PURE_COOL_LINK)
+        payload = {
+            'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA',
+            'time': '2021-03-17T15:09:23.000Z',
+            'data': {'tact': '2956', 'hact': '0047', 'pact': '0005', 'vact': 'INIT', 'sltm': 'OFF'}
+        }
+        good._handle_message(payload)
+
+        # No ENVIRONMENTAL message received, so rendering this one raises.
+        bad = libdyson.DysonPureCool(
+            'XX2-ZZ-1234ABCD', CREDENTIALS, libdyson.DEVICE_TYPE_PURE_COOL)
+
+        self.metrics.store('bad device', bad, is_environmental=True)
+        self.metrics.store(NAME, good, is_environmental=True)
+
+        labels = {'name': NAME, 'serial': SERIAL}
+        with self.assertLogs(level='ERROR'):
+            got = self.registry.get_sample_value('dyson_temperature_celsius', labels)
+        self.assertEqual(got, 22.6)
+
+    def test_store_devices_sharing_a_name(self):
+        payload = {
+            'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA',
+            'time': '2021-03-17T15:09:23.000Z',
+            'data': {'tact': '2956', 'hact': '0047', 'pact': '0005', 'vact': 'INIT', 'sltm': 'OFF'}
+        }
+        other_serial = 'XX2-ZZ-1234ABCD'
+        for serial in (SERIAL, other_serial):
+            device = libdyson.DysonPureCoolLink(
+                serial, CREDENTIALS, libdyson.DEVICE_TYPE_PURE_COOL_LINK)
+            device._handle_message(payload)
+            self.metrics.store(NAME, device, is_environmental=True)
+
+        for serial in (SERIAL, other_serial):
+            labels = {'name': NAME, 'serial': serial}
+            got = self.registry.get_sample_value('dyson_temperature_celsius', labels)
+            self.assertEqual(got, 22.6, f'serial {serial}')
+
     def test_update_v2_environmental(self):
         device = libdyson.DysonPureCool(
             SERIAL, CREDENTIALS, libdyson.DEVICE_TYPE_PURE_COOL)